@@ -2,6 +2,8 @@ import datetime
 import re
 import os
 
+__version__ = '0.1'
+
 class GolemError(Exception): pass
 class GolemRetryLater(Exception): pass
 
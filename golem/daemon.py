@@ -1,10 +1,14 @@
 import atexit
 import beanstalkc
+import collections
 import json
 import logging
 import os
+import Queue
 import signal
 import sys
+import threading
+import time
 import traceback
 import golem.repository
 import golem.db
@@ -17,6 +21,7 @@ class Daemon(object):
         # Set up a beanstalk connection
         self.bs_host, self.bs_port = bs_host, bs_port
         self.bs_queue = bs_queue
+        self.local = threading.local()
         self.connect()
         atexit.register(self.cleanup)
         signal.signal(signal.SIGTERM, self.cleanup)
@@ -25,6 +30,24 @@ class Daemon(object):
         self.bs = beanstalkc.Connection(host=self.bs_host, port=self.bs_port)
         self.bs.watch(self.bs_queue)
 
+    def put(self, queue, body, ttr):
+        # Threads other than the main thread use their own connection
+        for attempt in (1, 2):
+            local = getattr(self.local, 'bs', None)
+            bs = local or self.bs
+            try:
+                bs.use(queue)
+                return bs.put(body, ttr=ttr)
+            except beanstalkc.SocketError, e:
+                if attempt == 2:
+                    raise
+                self.logger.error("Connection to beanstalk failed: %s, reconnecting" % str(e))
+                bs.close()
+                if local:
+                    self.local.bs = beanstalkc.Connection(host=self.bs_host, port=self.bs_port)
+                else:
+                    self.connect()
+
     def run(self):
         while True:
             try:
@@ -98,22 +121,42 @@ class Daemon(object):
             self.logger.info("Exiting due to normal process exit")
 
 
+class Lane(object):
+    # Jobs for one repository, processed strictly in order
+    def __init__(self, name):
+        self.name = name
+        self.jobs = collections.deque()
+        self.current = []
+        self.busy = False
+        self.processed = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
 class Master(Daemon):
-    def __init__(self, logger, bs_host, bs_port, bs_queue, repo_dir, chems, db, do_update):
+    stats_interval = 60
+    touch_interval = 60
+
+    def __init__(self, logger, bs_host, bs_port, bs_queue, repo_dir, chems, db, do_update, concurrency=1):
         super(Master, self).__init__(logger, bs_host, bs_port, bs_queue)
         # Read repositories
         self.dummy = False
+        self.concurrency = int(concurrency)
+        self.lanes = {}
+        self.lane_lock = threading.Lock()
+        self.repo_lock = threading.Lock()
         self.repos = {}
+        self.states = {}
         self.repo_dir = repo_dir
         self.chems = chems
         self.engine = golem.db.create_engine(db, pool_recycle=3600)
-        golem.db.metadata.create_all(self.engine)
+        golem.db.upgrade(self.engine, self.logger)
+        golem.repository.cache.open(os.path.join(repo_dir, 'cache.sqlite'))
         self.read_repos()
-        gh = None
         for repo in self.repos.values():
-            if repo.reflogtype == 'github' and not gh:
-                self.logger.info("Verifying github login")
-                gh = golem.repository.github()
+            if repo.reflogtype == 'github' and not golem.repository.github.gh:
+                # Credentials are checked when github first rejects them
+                self.logger.info("Logging in to github")
+                golem.repository.github()
             if do_update:
                 self.logger.info("Updating %s" % repo.name)
                 repo.update()
@@ -121,13 +164,148 @@ class Master(Daemon):
     def read_repos(self):
         self.logger.info("Loading repositories from %s" % self.chems)
         db = self.engine.connect()
-        for file in os.listdir(self.chems):
-            if not file.endswith('.conf'):
-                continue
-            repo = golem.repository.Repository(self, os.path.join(self.chems, file), db)
+        files = [os.path.join(self.chems, x) for x in sorted(os.listdir(self.chems)) if x.endswith('.conf')]
+        chems = golem.repository.load_chems(files, os.path.join(self.repo_dir, '.chem-cache'))
+        for file in files:
+            repo = golem.repository.Repository(self, file, db, chems[file])
             self.repos[repo.name] = repo
         db.close()
 
+    def run(self):
+        if self.concurrency <= 1:
+            return super(Master, self).run()
+
+        # Jobs are reserved, touched, deleted and buried by this thread only,
+        # as beanstalk ties them to the connection that reserved them. Lanes
+        # are handed to the pool one batch at a time, so a repository never
+        # has more than one job in progress.
+        self.ready = Queue.Queue()
+        self.done = Queue.Queue()
+        for num in range(self.concurrency):
+            thread = threading.Thread(target=self.lane_worker, name='lane-worker-%d' % num)
+            thread.daemon = True
+            thread.start()
+        self.logger.info("Processing updates for up to %d repositories in parallel" % self.concurrency)
+
+        quitting = False
+        last_stats = last_touch = time.time()
+        while True:
+            self.finish_jobs()
+            if time.time() - last_touch > self.touch_interval:
+                self.touch_jobs()
+                last_touch = time.time()
+            if quitting:
+                with self.lane_lock:
+                    if not [x for x in self.lanes.values() if x.busy]:
+                        break
+                time.sleep(0.1)
+                continue
+            if time.time() - last_stats > self.stats_interval:
+                self.log_lane_stats()
+                last_stats = time.time()
+            try:
+                job = self.bs.reserve(timeout=1)
+            except beanstalkc.DeadlineSoon:
+                self.touch_jobs()
+                last_touch = time.time()
+                continue
+            except Exception, e:
+                self.logger.error("Connection to beanstalk failed: %s, reconnecting" % str(e))
+                self.connect()
+                continue
+            if not job:
+                continue
+            try:
+                data = json.loads(job.body)
+                repo = data['repo']
+            except (ValueError, KeyError, TypeError):
+                self.logger.warn("Invalid job received: %s" % job.body)
+                job.bury()
+                continue
+            if repo in ('quit', 'exit'):
+                self.logger.info("Exiting after finishing jobs in progress")
+                job.delete()
+                quitting = True
+                continue
+            with self.lane_lock:
+                if repo not in self.lanes:
+                    self.lanes[repo] = Lane(repo)
+                lane = self.lanes[repo]
+                lane.jobs.append((job, data))
+                lane.max_depth = max(lane.max_depth, len(lane.jobs))
+                self.logger.debug("Queued update for %s, lane depth %d" % (repo, len(lane.jobs)))
+                if not lane.busy:
+                    lane.busy = True
+                    self.ready.put(lane)
+        # Lanes that went idle since the last round left jobs to delete
+        self.finish_jobs()
+        self.log_lane_stats()
+
+    def lane_worker(self):
+        self.local.bs = beanstalkc.Connection(host=self.bs_host, port=self.bs_port)
+        while True:
+            lane = self.ready.get()
+            with self.lane_lock:
+                job, data = lane.jobs.popleft()
+                lane.current = [job]
+                more = []
+                # Consecutive post-receive jobs are handled in one go
+                while data.get('why') == 'post-receive' and lane.jobs and lane.jobs[0][1].get('why') == 'post-receive':
+                    more.append(lane.jobs.popleft())
+                    lane.current.append(more[-1][0])
+            try:
+                self.process_update(data, [x[1] for x in more])
+                what = 'delete'
+            except Exception:
+                for line in traceback.format_exc().split('\n'):
+                    self.logger.error(line)
+                what = 'bury'
+            with self.lane_lock:
+                for job in lane.current:
+                    self.done.put((job, what))
+                lane.current = []
+                lane.processed += 1 + len(more)
+                lane.coalesced += len(more)
+                if lane.jobs:
+                    self.ready.put(lane)
+                else:
+                    lane.busy = False
+
+    def finish_jobs(self):
+        while True:
+            try:
+                job, what = self.done.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                getattr(job, what)()
+            except Exception, e:
+                # The job will be released again when its ttr expires
+                self.logger.error("Unable to %s job %d: %s" % (what, job.jid, str(e)))
+
+    def touch_jobs(self):
+        # Jobs waiting in a lane or in progress must not be released by
+        # beanstalk when their ttr expires
+        with self.lane_lock:
+            jobs = [x[0] for lane in self.lanes.values() for x in lane.jobs] + [x for lane in self.lanes.values() for x in lane.current]
+        for job in jobs:
+            try:
+                job.touch()
+            except Exception, e:
+                self.logger.error("Unable to touch job %d: %s" % (job.jid, str(e)))
+
+    def lane_stats(self):
+        with self.lane_lock:
+            return dict([(x.name, {'depth': len(x.jobs), 'max_depth': x.max_depth, 'busy': x.busy,
+                                   'processed': x.processed, 'coalesced': x.coalesced})
+                         for x in self.lanes.values()])
+
+    def log_lane_stats(self):
+        for name, stats in sorted(self.lane_stats().items()):
+            if stats['depth'] or stats['busy']:
+                self.logger.info("Lane %s: %d queued (max %d), %d processed (%d coalesced)%s" %
+                    (name, stats['depth'], stats['max_depth'], stats['processed'], stats['coalesced'], ', busy' if stats['busy'] else ''))
+
     def process_job(self, job):
         try:
             job = json.loads(job.body)
@@ -137,35 +315,107 @@ class Master(Daemon):
         if job['repo'] in ('quit', 'exit'):
             self.logger.info("Exiting")
             return False
-        else:
-            db = self.engine.connect()
-            if job['repo'] not in self.repos:
-                # Are there new configfiles?
-                confs = [x.configfile for x in self.repos.values()]
-                for file in os.listdir(self.chems):
-                    if not file.endswith('.conf') or file in confs:
-                        continue
-                    repo = golem.repository.Repository(self, os.path.join(self.chems, file), db)
-                    self.repos[repo.name] = repo
-                if job['repo'] not in self.repos:
-                    self.logger.warning("Ignoring update for unknown repository %s" % job['repo'])
-                    return True
-            repo = self.repos[job['repo']]
-            if not os.path.exists(repo.configfile):
-                del self.repos[job['repo']]
-                self.logger.warning("Ignoring update for removed repository %s" % job['repo'])
-                return True
+        more = []
+        if job['why'] == 'post-receive':
+            more = self.drain_updates(job['repo'])
+        try:
+            self.process_update(job, [json.loads(x.body) for x in more])
+        except:
+            for x in more:
+                x.bury()
+            raise
+        for x in more:
+            x.delete()
+        return True
+
+    def drain_updates(self, repo, limit=1000):
+        # Reserve the queued post-receive jobs for the same repository, up to
+        # the first other kind of job for it. Jobs for other repositories are
+        # reserved along the way and released afterwards, beanstalk keeps
+        # their order as it goes by priority and job id.
+        more = []
+        skipped = []
+        while len(more) + len(skipped) < limit:
+            try:
+                job = self.bs.reserve(timeout=0)
+            except beanstalkc.DeadlineSoon:
+                break
+            if not job:
+                break
+            try:
+                data = json.loads(job.body)
+            except ValueError:
+                data = {}
+            if not isinstance(data, dict) or data.get('repo') != repo:
+                skipped.append(job)
+                continue
+            if data.get('why') != 'post-receive':
+                skipped.append(job)
+                break
+            more.append(job)
+        for job in skipped:
+            job.release()
+        return more
+
+    def process_update(self, job, more=[]):
+        if more:
+            self.logger.info("Coalesced %d post-receive updates for %s" % (len(more), job['repo']))
+            job = coalesce([job] + more)
+        db = self.engine.connect()
+        try:
+            with self.repo_lock:
+                repo = self.find_repo(job['repo'], db)
+            if not repo:
+                return
 
             self.logger.info("Update found for repo %s" % repo.name)
-            if os.path.getmtime(repo.configfile) > repo.mtime:
-                self.logger.info("Rereading configuration for %s" % repo.name)
-                repo = self.repos[job['repo']] = golem.repository.Repository(self, repo.configfile, db)
             if job['why'] in ('post-receive', 'reschedule'):
                 repo.update()
-            repo.schedule(job, db)
+            try:
+                repo.schedule(job, db)
+            except:
+                # The state index may no longer match the database
+                repo.state.reset()
+                raise
+            finally:
+                # Tell the web interface its cached pages are outdated
+                repo.changed()
+        finally:
             db.close()
-        os.chdir('/')
-        return True
+            os.chdir('/')
+
+    def find_repo(self, name, db):
+        if name not in self.repos:
+            # Are there new configfiles?
+            confs = [x.configfile for x in self.repos.values()]
+            for file in os.listdir(self.chems):
+                if not file.endswith('.conf') or file in confs:
+                    continue
+                repo = golem.repository.Repository(self, os.path.join(self.chems, file), db)
+                self.repos[repo.name] = repo
+            if name not in self.repos:
+                self.logger.warning("Ignoring update for unknown repository %s" % name)
+                return
+        repo = self.repos[name]
+        if not os.path.exists(repo.configfile):
+            del self.repos[name]
+            self.logger.warning("Ignoring update for removed repository %s" % name)
+            return
+
+        if os.path.getmtime(repo.configfile) > repo.mtime:
+            self.logger.info("Rereading configuration for %s" % repo.name)
+            repo = self.repos[name] = golem.repository.Repository(self, repo.configfile, db)
+        return repo
+
+def coalesce(jobs):
+    # Merge post-receive jobs into one that covers all their refs. A job
+    # without a ref means "look at everything", which covers all the others
+    refs = []
+    for job in jobs:
+        if not job.get('ref'):
+            return {'repo': job['repo'], 'why': 'post-receive', 'ref': None, 'prev_sha1': None, 'sha1': None}
+        refs += job.get('refs', [[job['ref'], job['prev_sha1'], job['sha1']]])
+    return {'repo': jobs[0]['repo'], 'why': 'post-receive', 'ref': None, 'prev_sha1': None, 'sha1': None, 'refs': refs}
 
 def killpid(pidfile, *matches):
     with open(pidfile) as fd:
@@ -37,3 +37,43 @@ artefact = Table('artefact', metadata,
     Column('sha1', String(40)),
     UniqueConstraint('filename', 'action'),
 )
+
+# Indexes for the queries golem actually runs. The unique constraints above
+# don't cover them: they start with the wrong column.
+commit_repository_submit_time = Index('commit_repository_submit_time', commit.c.repository, commit.c.submit_time)
+commit_repository_ref = Index('commit_repository_ref', commit.c.repository, commit.c.ref)
+action_commit_status = Index('action_commit_status', action.c.commit, action.c.status)
+artefact_action = Index('artefact_action', artefact.c.action)
+
+schema_version = Table('schema_version', metadata,
+    Column('version', Integer, nullable=False),
+)
+
+# Schema upgrades, in order. A fresh database is created at the latest
+# version, an existing one gets every upgrade past its recorded version.
+# Upgrades must be safe to run again: on mysql, every CREATE INDEX commits by
+# itself, so an upgrade that was interrupted may have been applied partially.
+def upgrade_1(db):
+    inspector = inspect(db)
+    for index in (commit_repository_submit_time, commit_repository_ref, action_commit_status, artefact_action):
+        if index.name not in [x['name'] for x in inspector.get_indexes(index.table.name)]:
+            index.create(db)
+
+migrations = [upgrade_1]
+
+def upgrade(engine, logger):
+    db = engine.connect()
+    try:
+        fresh = not engine.dialect.has_table(db, 'commit')
+        metadata.create_all(db)
+        version = db.execute(select([schema_version.c.version])).scalar()
+        if version is None:
+            version = fresh and len(migrations) or 0
+            db.execute(schema_version.insert().values(version=version))
+        for num, migration in enumerate(migrations[version:], version+1):
+            logger.info("Upgrading database schema to version %d" % num)
+            with db.begin():
+                migration(db)
+                db.execute(schema_version.update().values(version=num))
+    finally:
+        db.close()
@@ -6,17 +6,24 @@ import fnmatch
 import getpass
 import github3
 from   golem import GolemError, OutputLogger, RunLogger, now
+import cPickle
 import hashlib
 import json
 import keyword
 import logging
+import multiprocessing
 import os
+import Queue
+import random
 import re
 import requests
 import shlex
 import shutil
+import signal
 import socket
-import traceback
+import sqlite3
+import threading
+import time
 import whelk
 import golem.db
 import sqlalchemy.sql as sql
@@ -31,6 +38,18 @@ class IniConfig(object):
         for key in config.options(section):
             self._set(key, config.get(section, key), config=True)
 
+    # Loggers can't be pickled, so only their name is stored
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if 'logger' in state:
+            state['logger'] = state['logger'].name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'logger' in state:
+            self.logger = logging.getLogger(state['logger'])
+
     def _set(self, key, val, config=False):
         if isinstance(val, basestring):
             if "\n" in val:
@@ -57,15 +76,64 @@ class IniConfig(object):
             if config:
                 self.config[key] = val
 
-class Repository(IniConfig):
-    defaults = {'upstream': None, 'reflogtype': None, 'actions': {}, 'notifiers': {}, 'remote': {}}
-    def __init__(self, daemon, config, db):
-        self.configfile = config
-        self.mtime = os.path.getmtime(config)
-        config = ConfigParser(config)
-        IniConfig.__init__(self, config,    'repo')
+# The parsed contents of a chem file: the repository settings plus its
+# actions and notifiers, with inheritance between actions applied. This is
+# what the chem cache stores.
+class Chem(IniConfig):
+    defaults = {'upstream': None, 'reflogtype': None, 'actions': {}, 'notifiers': {}, 'remote': {}, 'fetch_timeout': 600,
+                'remote_fetch_timeout': 60, 'reflog_concurrency': 8}
+    def __init__(self, path, mtime):
+        self.configfile = path
+        self.mtime = mtime
+        config = ConfigParser(path)
+        IniConfig.__init__(self, config, 'repo')
         self.logger = logging.getLogger('golem.repo.' + self.name)
         self.logger.info("Parsing configuration for %s" % self.name)
+        if isinstance(self.fetch_timeout, basestring):
+            self.fetch_timeout = self.config['fetch_timeout'] = int(self.fetch_timeout)
+        if isinstance(self.remote_fetch_timeout, basestring):
+            self.remote_fetch_timeout = self.config['remote_fetch_timeout'] = int(self.remote_fetch_timeout)
+        if isinstance(self.reflog_concurrency, basestring):
+            self.reflog_concurrency = self.config['reflog_concurrency'] = int(self.reflog_concurrency)
+
+        for section in config.sections():
+            if section.startswith('action:'):
+                action = section[7:]
+                self.logger.info("  Adding action %s" % action)
+                self.actions[action] = Action(config, section)
+            elif section.startswith('notify:'):
+                nf = section[7:]
+                self.logger.info("  Adding notifier %s" % nf)
+                self.notifiers[nf] = Notifier(config, section)
+
+        self.graph = ActionGraph(self.actions)
+        for action in self.graph.order:
+            action = self.actions[action]
+            for req in self.graph.requires[action.name]:
+                req = self.actions[req]
+
+                # Backlog is "inherited" from the dependencies
+                if req.backlog < action.backlog:
+                    action.backlog = req.backlog
+
+                # Same for branches and tags. Intersection of all parents
+                if req.branches and not action.branches:
+                    action.branches = copy(req.branches)
+                elif req.branches:
+                    action.branches[:] = [x for x in action.branches if x in req.branches]
+                if req.tags and not action.tags:
+                    action.tags = copy(req.tags)
+                elif req.tags:
+                    action.tags[:] = [x for x in action.tags if x in req.tags]
+
+class Repository(object):
+    def __init__(self, daemon, config, db, chem=None):
+        self.configfile = config
+        self.mtime = os.path.getmtime(config)
+        chem_dir = os.path.join(daemon.repo_dir, '.chem-cache')
+        if not chem or (chem.configfile, chem.mtime) != (config, self.mtime):
+            chem = load_chem(config, self.mtime, chem_dir)
+        self.__dict__.update(chem.__dict__)
         self.path = os.path.join(daemon.repo_dir, self.name)
         self.repo_path = os.path.join(self.path, self.name + '.git')
         self.artefact_path = os.path.join(self.path, 'artefacts')
@@ -80,14 +148,14 @@ class Repository(IniConfig):
         elif self.upstream.startswith('file://'):
             self.reflogtype = 'file'
             self.upstream_path = self.upstream[7:]
-            if self.git('config', 'core.bare', cwd=self.upstream_path).stdout.strip() != 'false':
+            if git_config(self.shell, self.upstream_path).get('core.bare') != 'false':
                 self.upstream_path = os.path.join(self.upstream_path, '.git')
         elif ':' in self.upstream:
             self.reflogtype = 'ssh'
         else:
             self.reflogtype = 'file'
             self.upstream_path = self.upstream
-            if self.shell.git('config', 'core.bare', cwd=self.upstream).stdout.strip() != 'false':
+            if git_config(self.shell, self.upstream).get('core.bare') != 'false':
                 self.upstream_path = os.path.join(self.upstream_path, '.git')
 
         if re.match('^([a-z]+://|git@)github.com', self.upstream):
@@ -96,50 +164,15 @@ class Repository(IniConfig):
         if not self.reflogtype:
             raise GolemError("Don't know how to fetch reflogs for %s" % self.name)
 
-        for section in config.sections():
-            if section.startswith('action:'):
-                action = section[7:]
-                self.logger.info("  Adding action %s" % action)
-                self.actions[action] = Action(config, section)
-                self.actions[action].artefact_path = os.path.join(self.artefact_path, action)
-                self.actions[action].daemon = daemon
-                self.actions[action].repo_name = self.name
-            elif section.startswith('notify:'):
-                nf = section[7:]
-                self.logger.info("  Adding notifier %s" % nf)
-                self.notifiers[nf] = Notifier(config, section)
-                self.notifiers[nf].daemon = daemon
-                self.notifiers[nf].repo_name = self.name
-
-        changed = True
-        while changed:
-            changed = False
-            for action in self.actions:
-                for req in self.actions[action].requires:
-                    req = req[7:]
-
-                    # Backlog is "inherited" from the dependencies
-                    if self.actions[req].backlog < self.actions[action].backlog:
-                        changed = True
-                        self.actions[action].backlog = self.actions[req].backlog
-
-                    # Same for branches and tags. Intersection of all parents
-                    if self.actions[req].branches and not self.actions[action].branches:
-                        changed = True
-                        self.actions[action].branches = copy(self.actions[req].branches)
-                    elif self.actions[req].branches:
-                        for branch in self.actions[action].branches[:]:
-                            if branch not in self.actions[req].branches:
-                                changed = True
-                                self.actions[action].branches.remove(branch)
-                    if self.actions[req].tags and not self.actions[action].tags:
-                        changed = True
-                        self.actions[action].tags = copy(self.actions[req].tags)
-                    elif self.actions[req].tags:
-                        for tag in self.actions[action].tags[:]:
-                            if tag not in self.actions[req].tags:
-                                changed = True
-                                self.actions[action].tags.remove(tag)
+        for action in self.actions.values():
+            action.artefact_path = os.path.join(self.artefact_path, action.name)
+            action.daemon = daemon
+            action.repo_name = self.name
+        for nf in self.notifiers.values():
+            nf.daemon = daemon
+            nf.repo_name = self.name
+
+        self.matcher = RefMatcher(self.actions)
 
         if not daemon.dummy:
             self.create_dirs()
@@ -148,6 +181,12 @@ class Repository(IniConfig):
         self.id = db.execute(sql.select([_r.c.id]).where(_r.c.name==self.name)).fetchone()
         self.id = self.id.id if self.id else db.execute(_r.insert().values(name=self.name)).inserted_primary_key[0]
 
+        # The master shares the state index between instances of the same repository
+        states = getattr(daemon, 'states', {})
+        if self.name not in states or states[self.name].repo_id != self.id:
+            states[self.name] = State(self.id)
+        self.state = states[self.name]
+
     def last_commits(self, count, db):
         _c = golem.db.commit
         return db.execute(_c.select().where(_c.c.repository==self.id).order_by(sql.desc(_c.c.submit_time)).limit(count)).fetchall()
@@ -166,24 +205,51 @@ class Repository(IniConfig):
         return log
 
     def dependencies(self):
-        ret = []
-        for src in self.actions.values():
-            for dst in src.requires:
-                ret.append([src.name, dst[7:]])
-        return ret
+        return self.graph.edges
 
     def actions_for(self, ref, sha1, db):
         _c = golem.db.commit
+        cid = db.execute(_c.select('id').where(sql.and_(_c.c.repository==self.id, _c.c.ref==ref, _c.c.sha1==sha1))).fetchone()['id']
+        return self.actions_for_commits([cid], db)[cid]
+
+    def actions_for_commits(self, cids, db):
+        # Actions and their artefacts for many commits, in two queries
         _a = golem.db.action
         _f = golem.db.artefact
-        cid = db.execute(_c.select('id').where(sql.and_(_c.c.ref==ref, _c.c.sha1==sha1))).fetchone()['id']
-        data = db.execute(_a.select().where(_a.c.commit==cid).order_by(sql.asc(_a.c.start_time))).fetchall()
-        data = [{'name': x.name, 'status': x.status, 'start_time': x.start_time, 'end_time': x.end_time, 'host': x.host,
-            'duration': x.duration, 'config': self.actions[x.name].config,
-            'files':[{'filename': y.filename, 'sha1': y.sha1} for y in db.execute(_f.select().where(_f.c.action==x.id)).fetchall()]} 
-            for x in data if x.name in self.actions]
+        data = dict([(x, []) for x in cids])
+        if not cids:
+            return data
+        actions = db.execute(_a.select().where(_a.c.commit.in_(cids)).order_by(sql.asc(_a.c.start_time))).fetchall()
+        actions = [x for x in actions if x.name in self.actions]
+        files = collections.defaultdict(list)
+        if actions:
+            for file in db.execute(_f.select().where(_f.c.action.in_([x.id for x in actions]))).fetchall():
+                files[file.action].append({'filename': file.filename, 'sha1': file.sha1})
+        for x in actions:
+            data[x.commit].append({'name': x.name, 'status': x.status, 'start_time': x.start_time, 'end_time': x.end_time, 'host': x.host,
+                'duration': x.duration, 'config': self.actions[x.name].config, 'files': files[x.id]})
         return data
 
+    def artefact(self, ref, sha1, action, filename, db):
+        _c = golem.db.commit
+        _a = golem.db.action
+        _f = golem.db.artefact
+        return db.execute(sql.select([_f]).select_from(_f.join(_a, _f.c.action==_a.c.id).join(_c, _a.c.commit==_c.c.id)).where(
+            sql.and_(_c.c.repository==self.id, _c.c.ref==ref, _c.c.sha1==sha1, _a.c.name==action, _f.c.filename==filename))).fetchone()
+
+    def last_runs(self, count, db):
+        # The last commits with their actions, in three queries
+        commits = self.last_commits(count, db)
+        actions = self.actions_for_commits([x.id for x in commits], db)
+        return [(x, actions[x.id]) for x in commits]
+
+    def changed(self):
+        bump_counter(os.path.join(self.path, 'changes'))
+        bump_counter(os.path.join(os.path.dirname(self.path), '.changes'))
+
+    def changes(self):
+        return read_counter(os.path.join(self.path, 'changes'))
+
     def create_dirs(self):
         if not os.path.exists(self.artefact_path):
             os.makedirs(self.artefact_path)
@@ -191,52 +257,112 @@ class Repository(IniConfig):
     def update(self):
         self.logger.info("Processing update for %s" % self.name)
         if self.upstream:
-            if not os.path.exists(self.repo_path):
+            cloned = not os.path.exists(self.repo_path)
+            if cloned:
                 self.logger.info("Cloning %s" % self.upstream)
                 res = self.shell.git('clone', '--mirror', self.upstream, os.path.basename(self.repo_path), cwd=self.path)
                 if res.returncode != 0:
                     raise GolemError("Unable to clone repository: %s" % res.stdout)
                 self.git('config', 'core.logallrefupdates', 'false')
                 self.git('config', 'remote.origin.fetch', 'refs/heads/*:refs/heads/*')
-            else:
-                if self.git('config', 'remote.origin.url').stdout.strip() != self.upstream:
-                    self.logger.warning("Updating origin url")
-                    self.git('config', 'remote.origin.url', self.upstream)
-                if self.git('config', 'remote.origin.fetch').stdout.strip() != '+refs/heads/*:refs/heads/*':
-                    self.git('config', 'remote.origin.fetch', '+refs/heads/*:refs/heads/*')
-                self.logger.info("Fetching from %s" % self.upstream)
-                self.git('remote', 'prune', 'origin')
-                self.git('fetch', 'origin')
-            if self.remote:
-                _remotes = self.git('remote').stdout.strip().split()
-                for remote in self.remote:
-                    if remote not in _remotes:
-                        self.git('remote', 'add', remote, self.remote[remote])
-
-                    if self.git('config', 'remote.%s.url' % remote).stdout.strip() != self.remote[remote]:
-                        self.logger.warning("Updating %s url" % remote)
-                        self.git('config', 'remote.%s.url' % remote, self.remote[remote])
-                    self.logger.info("Fetching from %s" % self.remote[remote])
-                    try:
-                        self.git('remote', 'prune', remote)
-                        self.git('fetch', remote)
-                    except RuntimeError:
-                        # For secondary repos, exceptions are ok
-                        for line in traceback.format_exc().split('\n'):
-                            self.logger.error(line)
-            if self.git('ls-tree', 'HEAD', '.gitmodules').stdout.strip():
-                # This needs a workdir, so have a temporary one
-                wd = self.repo_path + '.work'
-                if not os.path.exists(wd):
-                    os.mkdir(wd)
-                env = {'GIT_DIR': self.repo_path, 'GIT_WORK_TREE': wd}
-                self.git('checkout', 'HEAD', cwd=wd, env=env)
-                self.git('reset', '--hard', 'HEAD', cwd=wd, env=env)
-                self.git('submodule', 'init', cwd=wd, env=env)
-                self.git('submodule', 'update', cwd=wd, env=env)
-                shutil.rmtree(wd)
+            config = git_config(self.shell, self.repo_path)
+            changes = {}
+            if not cloned:
+                changes['remote.origin.url'] = self.upstream
+                changes['remote.origin.fetch'] = '+refs/heads/*:refs/heads/*'
+            fetch = [] if cloned else ['origin']
+            for remote in sorted(self.remote):
+                if config.get('remote.%s.url' % remote) is None:
+                    changes['remote.%s.fetch' % remote] = '+refs/heads/*:refs/remotes/%s/*' % remote
+                changes['remote.%s.url' % remote] = self.remote[remote]
+                fetch.append(remote)
+            for key in config.set(changes):
+                self.logger.warning("Updated %s to %s" % (key, changes[key]))
+            self.fetch(fetch)
+            self.update_submodules()
         self.update_reflog()
 
+    def update_submodules(self):
+        # Submodules need a workdir, which we keep around between updates. It
+        # is only refreshed if .gitmodules or a gitlink changed since the
+        # HEAD we last checked, which is recorded for repositories without
+        # submodules too, so usually nothing needs to be done at all.
+        wd = self.repo_path + '.work'
+        marker = os.path.join(self.path, 'submodules.head')
+        head = self.shell.git('rev-parse', '--verify', '-q', 'HEAD').stdout.strip()
+        if not head:
+            return
+        old = None
+        if os.path.exists(marker):
+            with open(marker) as fd:
+                old = fd.read().strip()
+        if old == head:
+            return
+
+        refresh = True
+        if old:
+            res = self.shell.git('diff-tree', '-r', old, head)
+            if res.returncode == 0:
+                refresh = False
+                for line in res.stdout.splitlines():
+                    modes, path = line.split('\t', 1)
+                    if path == '.gitmodules' or '160000' in modes:
+                        refresh = True
+                        break
+        if refresh and self.git('ls-tree', 'HEAD', '.gitmodules').stdout.strip():
+            self.logger.info("Updating submodules")
+            if not os.path.exists(wd):
+                os.mkdir(wd)
+            env = {'GIT_DIR': self.repo_path, 'GIT_WORK_TREE': wd}
+            self.git('checkout', 'HEAD', cwd=wd, env=env)
+            self.git('reset', '--hard', 'HEAD', cwd=wd, env=env)
+            self.git('submodule', 'init', cwd=wd, env=env)
+            self.git('submodule', 'update', cwd=wd, env=env)
+        with open(marker, 'w') as fd:
+            fd.write(head + '\n')
+
+    def fetch(self, remotes):
+        # All remotes are fetched in parallel. Secondary remotes get a much
+        # shorter timeout than origin, so a hanging one doesn't hold up
+        # scheduling for long. Only failing to fetch from origin is fatal.
+        results = {}
+        def fetch(remote):
+            start = time.time()
+            timeout = self.fetch_timeout if remote == 'origin' else self.remote_fetch_timeout
+            try:
+                for attempt in range(3):
+                    if attempt:
+                        time.sleep(attempt + random.random())
+                    res = self.shell.timeout('--kill-after=10', str(timeout), 'git', 'fetch', '--prune', remote)
+                    # Concurrent fetches may race for packed-refs.lock
+                    if res.returncode == 0 or '.lock' not in res.stderr:
+                        break
+                results[remote] = (res.returncode, res.stderr.strip(), time.time() - start)
+            except Exception, e:
+                results[remote] = (-1, str(e), time.time() - start)
+
+        threads = []
+        for remote in remotes:
+            self.logger.info("Fetching from %s" % (self.upstream if remote == 'origin' else self.remote[remote]))
+            threads.append(threading.Thread(target=fetch, args=(remote,), name='fetch-%s-%s' % (self.name, remote)))
+            threads[-1].start()
+        for thread in threads:
+            thread.join()
+
+        for remote in remotes:
+            returncode, stderr, duration = results[remote]
+            if returncode == 0:
+                self.logger.info("Fetched %s in %.1f seconds" % (remote, duration))
+                continue
+            if returncode in (124, 137):
+                error = "git fetch %s timed out after %.1f seconds" % (remote, duration)
+            else:
+                error = "git fetch %s failed after %.1f seconds: %s" % (remote, duration, stderr)
+            if remote == 'origin':
+                raise RuntimeError(error)
+            # For secondary repos, errors are ok
+            self.logger.error(error)
+
     def update_reflog(self):
         if self.reflogtype == 'file':
             self.shell.rsync(os.path.join(self.upstream_path, 'logs/'),
@@ -245,17 +371,10 @@ class Repository(IniConfig):
             self.shell.rsync('%s/logs/' % self.upstream, os.path.join(self.repo_path, 'logs/'))
         elif self.reflogtype == 'http':
             branches = self.git('for-each-ref', '--format', '%(refname:short)', 'refs/heads').stdout.splitlines()
-            for branch in branches:
-                logpath = os.path.join(self.repo_path, 'logs', 'refs', 'heads', branch)
-                if not os.path.exists(os.path.dirname(logpath)):
-                    os.makedirs(os.path.dirname(logpath))
-                res = requests.get(self.reflogurl.replace('%REF%', 'refs/heads/%s' % branch))
-                if res.status_code != 200:
-                    raise GolemError("Unable to fetch reflog for branch: %s" % r.status_code)
-                with open(logpath, 'w') as fd:
-                    fd.write(res.text.encode('utf-8'))
+            self.fetch_http_reflogs(branches)
         elif self.reflogtype == 'github':
             gh = github()
+            calls = github.calls()
             BOGUS_SHA1 = '1' * 40
             user, repo = self.upstream.rsplit('/', 3)[-2:]
             # For ssh urls
@@ -265,9 +384,16 @@ class Repository(IniConfig):
                 repo = repo[:-4]
             repo = gh.repository(user, repo)
             branches = collections.defaultdict(list)
-            heads = {}
+            cursor = self.load_json('github.json', {'last_id': 0, 'etag': None})
 
-            for event in repo.iter_events(number=300):
+            # Events come newest first, so we can stop at the first one we've
+            # already seen. With the etag, github answers 304 if nothing happened.
+            events = repo.iter_events(number=300, etag=cursor['etag'])
+            last_id = cursor['last_id']
+            for event in events:
+                if int(event.id) <= cursor['last_id']:
+                    break
+                last_id = max(last_id, int(event.id))
                 if event.type == 'CreateEvent' and event.payload['ref_type'] == 'branch':
                     # log --reverse -n1 does not what I expect: it outputs only the *last*
                     # commit. I want the first.
@@ -281,7 +407,7 @@ class Repository(IniConfig):
                     push = (
                         '0' * 40,
                         sha,
-                        cache(gh.user, event.actor.login).name,
+                        actor_name(gh, event.actor.login),
                         '<%s@github>' % event.actor.login,
                         event.created_at.strftime('%s +0000'),
                         'push',
@@ -294,35 +420,125 @@ class Repository(IniConfig):
                 push = (
                     event.payload.get('before',BOGUS_SHA1), # Older events don't have 'before'
                     event.payload['head'],
-                    cache(gh.user, event.actor.login).name,
+                    actor_name(gh, event.actor.login),
                     '<%s@github>' % event.actor.login,
                     event.created_at.strftime('%s +0000'),
                     'push',
                 )
-                heads[event.payload['head']] = 1
                 branches[event.payload['ref']].append(push)
+            if events.last_status not in (200, 304):
+                raise GolemError("Unable to fetch events for %s: %s" % (self.upstream, events.last_status))
 
             for branch in branches:
                 branches[branch].reverse()
                 log_path = os.path.join(self.repo_path, 'logs', branch)
-                if os.path.exists(log_path):
-                   with open(log_path) as fd:
-                       log = fd.readlines()
-                   for line in log:
-                       old, new, junk = line.strip().split(None, 2)
-                       if new not in heads:
-                           name, mail, ts, tz, psh = junk.rsplit(None, 4)
-                           branches[branch].append((old, new, name, mail, '%s %s' % (ts, tz), psh))
-                   branches[branch].sort(key=lambda x: x[4])
-                log = "\n".join([' '.join(push) for push in branches[branch]]) + "\n"
-
                 if not os.path.exists(os.path.dirname(log_path)):
                     os.makedirs(os.path.dirname(log_path))
-                with open(log_path, 'w') as fd:
-                    fd.write(log)
+                # Without a cursor, these events may have been written by an
+                # earlier version that rewrote the whole file
+                if not cursor['last_id'] and os.path.exists(log_path):
+                    with open(log_path) as fd:
+                        seen = set([line.split(None, 2)[1] for line in fd if line.strip()])
+                    branches[branch] = [push for push in branches[branch] if push[1] not in seen]
+                with open(log_path, 'a') as fd:
+                    for push in branches[branch]:
+                        fd.write(' '.join(push).encode('utf-8') + "\n")
+
+            if branches:
+                stats = cache.stats()
+                self.logger.info("Actor name cache: %d hits, %d misses" % (stats['hits'], stats['misses']))
+            self.logger.info("Made %d github api calls" % (github.calls() - calls))
+            self.save_json('github.json', {'last_id': last_id, 'etag': events.etag or cursor['etag']})
         else:
             raise GolemError("Don't know how to fetch the reflog")
 
+    def load_json(self, name, default):
+        path = os.path.join(self.path, name)
+        if os.path.exists(path):
+            try:
+                with open(path) as fd:
+                    return json.load(fd)
+            except ValueError:
+                self.logger.warning("Ignoring corrupt state file %s" % path)
+        return default
+
+    def save_json(self, name, data):
+        path = os.path.join(self.path, name)
+        with open(path + '.new', 'w') as fd:
+            json.dump(data, fd)
+        os.rename(path + '.new', path)
+
+    def fetch_http_reflogs(self, branches):
+        # Reflogs are append-only, so we only ask for what was added since the
+        # last fetch, overlapping by one byte to check that the file wasn't
+        # rewritten. Servers that ignore Range get us the full file anyway.
+        cursor = self.load_json('reflogs.json', {})
+        new_cursor = {}
+        errors = []
+        queue = Queue.Queue()
+        for branch in branches:
+            queue.put(branch)
+
+        def fetch_one(branch):
+            url = self.reflogurl.replace('%REF%', 'refs/heads/%s' % branch)
+            logpath = os.path.join(self.repo_path, 'logs', 'refs', 'heads', branch)
+            if not os.path.exists(os.path.dirname(logpath)):
+                os.makedirs(os.path.dirname(logpath))
+            size = os.path.getsize(logpath) if os.path.exists(logpath) else 0
+            known = cursor.get(branch, {})
+            headers = {}
+            if size and known.get('size') == size:
+                headers['Range'] = 'bytes=%d-' % (size - 1)
+                if known.get('etag'):
+                    headers['If-None-Match'] = known['etag']
+                if known.get('last_modified'):
+                    headers['If-Modified-Since'] = known['last_modified']
+            res = http_session.get(url, headers=headers, timeout=60)
+            if res.status_code == 304:
+                new_cursor[branch] = known
+                return
+            if res.status_code == 416:
+                # Nothing at or beyond our last byte, so the file shrank
+                res = http_session.get(url, timeout=60)
+            elif res.status_code == 206:
+                start = re.match(r'bytes (\d+)-', res.headers.get('Content-Range', ''))
+                if start and int(start.group(1)) == size - 1 and res.content[:1] == '\n':
+                    with open(logpath, 'ab') as fd:
+                        fd.write(res.content[1:])
+                    new_cursor[branch] = {'size': size + len(res.content) - 1,
+                        'etag': res.headers.get('ETag'), 'last_modified': res.headers.get('Last-Modified')}
+                    return
+                res = http_session.get(url, timeout=60)
+            if res.status_code != 200:
+                errors.append("Unable to fetch reflog for branch %s: %s" % (branch, res.status_code))
+                return
+            with open(logpath, 'wb') as fd:
+                fd.write(res.content)
+            new_cursor[branch] = {'size': len(res.content),
+                'etag': res.headers.get('ETag'), 'last_modified': res.headers.get('Last-Modified')}
+
+        def worker():
+            while True:
+                try:
+                    branch = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    fetch_one(branch)
+                except Exception, e:
+                    errors.append("Unable to fetch reflog for branch %s: %s" % (branch, str(e)))
+
+        threads = []
+        for num in range(min(self.reflog_concurrency, len(branches))):
+            threads.append(threading.Thread(target=worker, name='reflog-%s-%d' % (self.name, num)))
+            threads[-1].start()
+        for thread in threads:
+            thread.join()
+        # Keep what we did fetch, even if some branches failed
+        self.save_json('reflogs.json', new_cursor)
+        if errors:
+            raise GolemError(errors[0])
+
     def schedule(self, job, db):
         ref = job.get('ref', None)
         why = job['why']
@@ -330,47 +546,52 @@ class Repository(IniConfig):
 
         _c = golem.db.commit
         _a = golem.db.action
-        _r = golem.db.repository
         _f = golem.db.artefact
 
         refs = {}
         tags = []
         if why == 'reschedule':
             if job['sha1']:
-                c = db.execute(_c.select().where(sql.and_(_c.c.ref==job['ref'], _c.c.sha1==job['sha1']))).fetchone()
+                c = self.state.commit(job['ref'], job['sha1'], db)
                 if not c:
                     self.logger.error("Commit %s for ref %s cannot be rescheduled, it does not exist" % (job['sha1'], job['ref']))
                     return
             else:
-                c = db.execute(_c.select().where(_c.c.ref==job['ref']).order_by(sql.desc(_c.c.submit_time)).limit(1)).fetchone()
+                c = self.state.last_commit(job['ref'], db)
                 if not c:
                     self.logger.error("Cannot reschedule actions for ref %s, no commits were processed yet" % job['ref'])
                     return
-            job['prev_sha1'], job['sha1'] = c.prev_sha1, c.sha1
+            job['prev_sha1'], job['sha1'] = c['prev_sha1'], c['sha1']
 
-        if ref and ref.startswith(('refs/heads', 'refs/tags')):
-            refs[ref] = [(job['prev_sha1'], job['sha1'])]
-        if ref and ref.startswith('refs/tags'):
-            tags = [(ref, 0)]
+        # Coalesced post-receive jobs carry a list of refs
+        for ref_, prev_sha1, sha1 in job.get('refs', [[ref, job.get('prev_sha1'), job.get('sha1')]]):
+            if ref_ and ref_.startswith(('refs/heads', 'refs/tags')):
+                refs.setdefault(ref_, []).append((prev_sha1, sha1))
+            if ref_ and ref_.startswith('refs/tags') and (ref_, 0) not in tags:
+                tags.append((ref_, 0))
 
         if why == 'action-started':
-            res = db.execute(_a.join(_c).join(_r).select(use_labels=True).where(
-                    sql.and_(_r.c.name == job['repo'], _c.c.ref==job['ref'], _c.c.sha1==job['sha1'], _a.c.name==job['action']))).fetchone()
-            aid, cid = res.action_id, res.commit_id
+            act = self.state.commit(job['ref'], job['sha1'], db)['actions'][job['action']]
             db.execute(_a.update().values(status='started', start_time=datetime.datetime.utcfromtimestamp(job['start_time']),
-                host=job['host']).where(_a.c.id==aid))
+                host=job['host']).where(_a.c.id==act['id']))
+            act['status'] = 'started'
 
         if why == 'action-done':
-            res = db.execute(_a.join(_c).join(_r).select(use_labels=True).where(
-                    sql.and_(_r.c.name == job['repo'], _c.c.ref==job['ref'], _c.c.sha1==job['sha1'], _a.c.name==job['action']))).fetchone()
-            aid, cid = res.action_id, res.commit_id
+            c = self.state.commit(job['ref'], job['sha1'], db)
+            act = c['actions'][job['action']]
+            aid = act['id']
             db.execute(_a.update().values(status=job['result'], start_time=datetime.datetime.utcfromtimestamp(job['start_time']), 
                                           end_time=datetime.datetime.utcfromtimestamp(job['end_time']), duration=job['duration'],
                                           host=job['host']).where(_a.c.id==aid))
+            act['status'] = job['result']
+            status = None
             if job['result'] == 'fail':
-                db.execute(_c.update().values(status=job['result']).where(_c.c.id==cid))
-            elif db.execute(sql.select([sql.func.count(_a.c.id)]).where(sql.and_(_a.c.status!='success', _a.c.commit==cid))).scalar() == 0:
-                db.execute(_c.update().values(status='success').where(_c.c.id==cid))
+                status = 'fail'
+            elif not [x for x in c['actions'].values() if x['status'] != 'success']:
+                status = 'success'
+            if status:
+                db.execute(_c.update().values(status=status).where(_c.c.id==c['id']))
+                c['status'] = status
             artefact_path = os.path.join(self.actions[job['action']].artefact_path, '%s@%s' % (job['ref'], job['sha1']))
             for path, _, files in os.walk(artefact_path):
                 for file in files:
@@ -388,26 +609,9 @@ class Repository(IniConfig):
                     if fnmatch.fnmatch('action:' + job['action'], what):
                         nf.schedule(job)
 
+        cursor = None
         if why == 'post-receive' and not refs:
-            for head in self.git('for-each-ref', '--format', '%(refname)', 'refs/heads').stdout.splitlines():
-                lf = os.path.join(self.repo_path, 'logs', 'refs', 'heads', head[11:])
-                if not os.path.exists(lf):
-                    refs[head] = []
-                else:
-                    with open(lf) as fd:
-                        log = fd.readlines()
-                        refs[head] = [x.split(None, 2)[:2] for x in log]
-            null = '0' * 40
-            for tag in self.git('for-each-ref', '--format', '%(refname) %(*objectname) %(objectname) %(taggerdate:raw) %(committerdate:raw)', 'refs/tags').stdout.splitlines():
-                data = tag.split()
-                if not (data[-2].isdigit() and data[-1][1:].isdigit()):
-                    # Severely broken tag 
-                    continue
-                tag, sha = data[:2]
-                ts = data[-2:]
-                ts = int(ts[0]) + (-1 if ts[1][0] == '-' else 1) * (3600 * int(ts[1][1:3]) + 60 * int(ts[1][3:]))
-                refs[tag] = [(null, sha)]
-                tags.append((tag, ts))
+            refs, tags, cursor = self.read_refs()
 
         if why == 'reschedule':
             # Set actions back to 'new'
@@ -416,72 +620,178 @@ class Repository(IniConfig):
             if job['action']:
                 actions = [job['action']]
             else:
-                actions = [x.name for x in db.execute(_a.select().where(sql.and_(_a.c.commit==c.id, _a.c.status=='retry'))).fetchall()]
-            added = True
-            while added:
-                added = False
-                for aname, action in self.actions.items():
-                    if aname in actions:
-                        continue
-                    for act in actions:
-                        if 'action:' + act in action.requires:
-                            added = True
-                            actions.append(aname)
-                            break
+                actions = [x for x in c['actions'] if c['actions'][x]['status'] == 'retry']
+            for action in actions[:]:
+                actions += [x for x in self.graph.descendants.get(action, ()) if x not in actions]
             for action in actions:
                 self.actions[action].clean(job['ref'], job['sha1'])
             db.execute(_a.update().values(status='new',host=None, start_time=None, end_time=None,
-                       duration=None).where(sql.and_(_a.c.commit==c.id, _a.c.name.in_(actions))))
+                       duration=None).where(sql.and_(_a.c.commit==c['id'], _a.c.name.in_(actions))))
+            for action in actions:
+                if action in c['actions']:
+                    c['actions'][action]['status'] = 'new'
 
         tags.sort(key=lambda x: x[1], reverse=True)
+        self.schedule_refs(refs, tags, db, job['action'] if why == 'action-done' else None)
+        if cursor:
+            self.save_cursor(cursor)
+        self.state.trim()
+
+    # To avoid rereading all reflogs and tags on every update, we keep a
+    # cursor: how far we got in each reflog and the tags we've seen. Only new
+    # reflog entries and new or changed tags are returned, unless the
+    # configuration changed or a reflog was rewritten.
+    def read_refs(self):
+        cursor = self.load_cursor()
+        full = cursor.get('mtime') != self.mtime
+        new_cursor = {'mtime': self.mtime, 'reflogs': {}, 'tags': {}}
+        refs = {}
 
-        for aname, action in self.actions.items():
-            if job['why'] == 'action-done' and 'action:' + job['action'] not in action.requires:
+        for head in self.git('for-each-ref', '--format', '%(refname)', 'refs/heads').stdout.splitlines():
+            lf = os.path.join(self.repo_path, 'logs', 'refs', 'heads', head[11:])
+            if not os.path.exists(lf):
+                refs[head] = []
                 continue
-            my_tags = []
-            for tag in tags:
-                tag = tag[0][10:]
-                for tag_ in action.tags:
-                    if tag_ == tag or (hasattr(tag_, 'match') and tag_.match(tag)):
-                        my_tags.append(tag)
-            my_tags = my_tags[:action.backlog+1]
-            for ref in refs:
-                # Do we want to handle this thing?
-                handle = False
-                if ref.startswith('refs/heads'):
-                    head = ref[11:]
-                    for head_ in action.branches:
-                        if head_ == head or (hasattr(head_, 'match') and head_.match(head)):
-                            handle = True
-                            break
-                elif ref.startswith('refs/tags'):
-                    tag = ref[10:]
-                    if tag in my_tags:
-                        handle = True
-
-                if not handle:
+            # The last line we read must still be where we left it
+            offset, taillen, tailsha = cursor['reflogs'].get(head, (0, 0, None)) if not full else (0, 0, None)
+            with open(lf) as fd:
+                if offset:
+                    fd.seek(0, os.SEEK_END)
+                    if fd.tell() < offset:
+                        offset = 0
+                    else:
+                        fd.seek(offset - taillen)
+                        if hashlib.sha1(fd.read(taillen)).hexdigest() != tailsha:
+                            offset = 0
+                if not offset:
+                    fd.seek(0)
+                log = fd.read()
+            # Don't consume a partially written last line
+            if not log.endswith('\n'):
+                log = log[:log.rfind('\n')+1]
+            lines = log.splitlines(True)
+            refs[head] = [x.split(None, 2)[:2] for x in lines]
+            if lines:
+                offset, taillen, tailsha = offset + len(log), len(lines[-1]), hashlib.sha1(lines[-1]).hexdigest()
+            new_cursor['reflogs'][head] = (offset, taillen, tailsha)
+
+        null = '0' * 40
+        # In for-each-ref order, which decides between tags with the same
+        # timestamp when they are ranked for the backlog
+        seen = collections.OrderedDict([x.split() for x in self.git('for-each-ref', '--format', '%(refname) %(objectname)', 'refs/tags').stdout.splitlines()])
+        known = cursor['tags']
+        changed = [x for x in seen if x not in known or known[x][0] != seen[x]]
+        if changed:
+            for tag in self.git('for-each-ref', '--format', '%(refname) %(*objectname) %(objectname) %(taggerdate:raw) %(committerdate:raw)',
+                                *(changed if len(changed) < 100 else ['refs/tags'])).stdout.splitlines():
+                data = tag.split()
+                tag = data[0]
+                if tag not in seen:
                     continue
+                if not (data[-2].isdigit() and data[-1][1:].isdigit()):
+                    # Severely broken tag 
+                    known[tag] = (seen[tag], None, None)
+                    continue
+                sha = data[1]
+                ts = data[-2:]
+                ts = int(ts[0]) + (-1 if ts[1][0] == '-' else 1) * (3600 * int(ts[1][1:3]) + 60 * int(ts[1][3:]))
+                known[tag] = (seen[tag], sha, ts)
+        tags = []
+        for tag in seen:
+            if tag not in known:
+                continue
+            new_cursor['tags'][tag] = known[tag]
+            objectname, sha, ts = known[tag]
+            if not sha:
+                continue
+            tags.append((tag, ts))
+            if full or tag in changed:
+                refs[tag] = [(null, sha)]
+
+        return refs, tags, new_cursor
+
+    def load_cursor(self):
+        return self.load_json('cursor.json', {'mtime': None, 'reflogs': {}, 'tags': {}})
+
+    def save_cursor(self, cursor):
+        self.save_json('cursor.json', cursor)
+
+    def schedule_refs(self, refs, tags, db, done_action=None):
+        _c = golem.db.commit
+        _a = golem.db.action
+
+        # First figure out in memory which (action, ref, sha1) combinations we want
+        if done_action:
+            actions = dict([(x, self.actions[x]) for x in self.graph.dependents[done_action]])
+        else:
+            actions = self.actions
+        my_tags = dict([(x, set()) for x in actions])
+        for tag, ts in tags:
+            for aname in self.matcher.match(tag):
+                if aname in my_tags and len(my_tags[aname]) <= actions[aname].backlog:
+                    my_tags[aname].add(tag)
 
+        wanted = []
+        for ref in refs:
+            # Do we want to handle this thing?
+            for aname in self.matcher.match(ref):
+                if aname not in actions or (ref.startswith('refs/tags/') and ref not in my_tags[aname]):
+                    continue
+                action = actions[aname]
                 for prev_sha1, sha1 in refs[ref][-(action.backlog+1):]:
-                    cid = db.execute(_c.select().where(_c.c.repository==self.id).where(_c.c.ref==ref).where(_c.c.sha1==sha1)).fetchone()
-                    cid = cid.id if cid else db.execute(_c.insert().values(repository=self.id, ref=ref, sha1=sha1, prev_sha1=prev_sha1,
-                                                        submit_time=now(), status='new')).inserted_primary_key[0]
-                    act = db.execute(_a.select().where(_a.c.commit==cid).where(_a.c.name==action.name)).fetchone()
-                    if not act:
-                        db.execute(_a.insert().values(commit=cid, name=action.name, status='new'))
-                        act = db.execute(_a.select().where(_a.c.commit==cid).where(_a.c.name==action.name)).fetchone()
-
-                    # Check if all dependencies have been met
-                    if action.requires:
-                        requires = [x.replace('action:','') for x in action.requires]
-                        actions = db.execute(_a.select().where(_a.c.commit==cid).where(_a.c.name.in_(requires)).where(_a.c.status=='success')).fetchall()
-                        if len(actions) != len(action.requires):
-                            continue
-
-                    if act.status == 'new':
-                        db.execute(_a.update().where(_a.c.id==act.id).values(status='scheduled'))
-                        db.execute(_c.update().where(sql.and_(_c.c.id==cid, _c.c.status!='fail')).values(status='in-progress'))
-                        action.schedule(ref, prev_sha1, sha1)
+                    wanted.append((action, ref, prev_sha1, sha1))
+
+        if not wanted:
+            return
+
+        # Then add what's missing to the database and compute the status
+        # transitions from the state index, writing back in one transaction
+        state = self.state
+        state.load([(x[1], x[3]) for x in wanted], db)
+        to_schedule = []
+        with db.begin():
+            new = collections.OrderedDict()
+            for action, ref, prev_sha1, sha1 in wanted:
+                if (ref, sha1) not in state.commits and (ref, sha1) not in new:
+                    new[(ref, sha1)] = {'repository': self.id, 'ref': ref, 'sha1': sha1, 'prev_sha1': prev_sha1,
+                                        'submit_time': now(), 'status': 'new'}
+            if new:
+                db.execute(_c.insert(), new.values())
+                state.load(new.keys(), db)
+
+            new = collections.OrderedDict()
+            for action, ref, prev_sha1, sha1 in wanted:
+                c = state.commits[(ref, sha1)]
+                if action.name not in c['actions'] and (c['id'], action.name) not in new:
+                    new[(c['id'], action.name)] = {'commit': c['id'], 'name': action.name, 'status': 'new'}
+            if new:
+                db.execute(_a.insert(), new.values())
+                state.load_actions(set([x[0] for x in new]), db)
+
+            for action, ref, prev_sha1, sha1 in wanted:
+                c = state.commits[(ref, sha1)]
+                act = c['actions'][action.name]
+
+                # Check if all dependencies have been met
+                if action.requires:
+                    if [x for x in action.requires if c['actions'].get(x[7:], {}).get('status') != 'success']:
+                        continue
+
+                if act['status'] == 'new':
+                    act['status'] = 'scheduled'
+                    to_schedule.append((action, ref, prev_sha1, sha1, act['id'], c))
+
+            for aids in chunked([x[4] for x in to_schedule]):
+                db.execute(_a.update().where(_a.c.id.in_(aids)).values(status='scheduled'))
+            commits = dict([(x[5]['id'], x[5]) for x in to_schedule])
+            for cids in chunked(commits.keys()):
+                db.execute(_c.update().where(sql.and_(_c.c.id.in_(cids), _c.c.status!='fail')).values(status='in-progress'))
+            for c in commits.values():
+                if c['status'] != 'fail':
+                    c['status'] = 'in-progress'
+
+        for action, ref, prev_sha1, sha1, aid, c in to_schedule:
+            action.schedule(ref, prev_sha1, sha1)
 
     def git(self, *args, **kwargs):
         res = self.shell.git(*args, **kwargs)
@@ -531,7 +841,6 @@ class Action(IniConfig):
 
     def schedule(self, ref, prev_sha1, sha1):
         self.logger.info("Scheduling %s for %s@%s" % (self.name, ref, sha1))
-        self.daemon.bs.use(self.queue)
         data = {'repo': self.repo_name, 'ref': ref, 'prev_sha1': prev_sha1, 'sha1': sha1, 'action': self.name}
         data.update(self.config)
         if 'tags' in data:
@@ -539,7 +848,7 @@ class Action(IniConfig):
         if 'branches' in data:
             data['branches'] = [x.pattern if hasattr(x, 'pattern') else x for x in data['branches']]
 
-        self.daemon.bs.put(json.dumps(data), ttr=self.ttr)
+        self.daemon.put(self.queue, json.dumps(data), ttr=self.ttr)
         if sha1:
             ref += '@' + sha1
         if not os.path.exists(os.path.join(self.artefact_path, ref)):
@@ -565,13 +874,170 @@ class Notifier(IniConfig):
 
     def schedule(self, job):
         self.logger.info("Scheduling %s notifications for %s@%s" % (job['action'], job['ref'], job['sha1']))
-        self.daemon.bs.use(self.queue)
         data = job.copy()
         data.update(self.config)
-        self.daemon.bs.put(json.dumps(data), ttr=self.ttr)
+        self.daemon.put(self.queue, json.dumps(data), ttr=self.ttr)
+
+# The dependency graph between the actions of a repository, with the actions
+# in topological order and the ancestors and descendants of every action
+# precomputed.
+class ActionGraph(object):
+    def __init__(self, actions):
+        self.requires = {}
+        self.dependents = dict([(x, []) for x in actions])
+        self.edges = []
+        for name in sorted(actions):
+            self.requires[name] = []
+            for req in actions[name].requires:
+                req = req[7:]
+                if req not in actions:
+                    raise GolemError("Action %s requires unknown action %s" % (name, req))
+                self.requires[name].append(req)
+                self.dependents[req].append(name)
+                self.edges.append([name, req])
+
+        self.order = []
+        todo = dict([(x, len(self.requires[x])) for x in actions])
+        ready = sorted([x for x in todo if not todo[x]])
+        while ready:
+            name = ready.pop(0)
+            self.order.append(name)
+            for dep in self.dependents[name]:
+                todo[dep] -= 1
+                if not todo[dep]:
+                    ready.append(dep)
+        if len(self.order) != len(actions):
+            raise GolemError("Circular dependency between actions: %s" % ' -> '.join(self.find_cycle(set(actions) - set(self.order))))
+
+        self.ancestors = {}
+        for name in self.order:
+            self.ancestors[name] = set(self.requires[name])
+            for req in self.requires[name]:
+                self.ancestors[name] |= self.ancestors[req]
+        self.descendants = {}
+        for name in reversed(self.order):
+            self.descendants[name] = set(self.dependents[name])
+            for dep in self.dependents[name]:
+                self.descendants[name] |= self.descendants[dep]
+
+    def find_cycle(self, names):
+        # Every action left over after sorting is in a cycle or depends on one
+        path = [sorted(names)[0]]
+        while True:
+            name = [x for x in self.requires[path[-1]] if x in names][0]
+            if name in path:
+                return path[path.index(name):] + [name]
+            path.append(name)
+
+# Finds the actions interested in a ref. Exact branch and tag names are
+# looked up in a dict, regexes are combined into a single alternation that
+# rejects most refs in one go and only refs that pass it are matched against
+# the individual patterns. Results are cached, a matcher is rebuilt whenever
+# the configuration is reread.
+class RefMatcher(object):
+    def __init__(self, actions):
+        self.exact = {'refs/heads/': collections.defaultdict(set), 'refs/tags/': collections.defaultdict(set)}
+        self.patterns = {'refs/heads/': collections.defaultdict(set), 'refs/tags/': collections.defaultdict(set)}
+        for action in actions.values():
+            for prefix, refs in (('refs/heads/', action.branches), ('refs/tags/', action.tags)):
+                for ref in refs:
+                    if hasattr(ref, 'match'):
+                        self.patterns[prefix][ref.pattern].add(action.name)
+                    else:
+                        self.exact[prefix][ref].add(action.name)
+        self.combined = {}
+        for prefix, patterns in self.patterns.items():
+            self.patterns[prefix] = [(re.compile(x), frozenset(y)) for x, y in patterns.items()]
+            try:
+                self.combined[prefix] = re.compile('|'.join(['(?:%s)' % x for x in patterns]))
+            except (re.error, AssertionError):
+                # Backreferences and such don't survive being combined, and
+                # python 2 refuses more than 100 groups with an AssertionError
+                self.combined[prefix] = None
+        self.cache = {}
+
+    def match(self, ref):
+        if ref in self.cache:
+            return self.cache[ref]
+        ret = set()
+        for prefix in self.exact:
+            if not ref.startswith(prefix):
+                continue
+            name = ref[len(prefix):]
+            ret.update(self.exact[prefix].get(name, ()))
+            if self.patterns[prefix] and (not self.combined[prefix] or self.combined[prefix].match(name)):
+                for pattern, actions in self.patterns[prefix]:
+                    if pattern.match(name):
+                        ret.update(actions)
+        ret = self.cache[ref] = frozenset(ret)
+        return ret
+
+# Write-through index of the commit and action state of a repository, keyed
+# by (ref, sha1). Only the commits an update touches are loaded, together with
+# their actions, and the least recently used ones are dropped once there are
+# more than `size`. Everything that writes commit/action state must update the
+# index too, the database remains the source of truth on restart.
+class State(object):
+    def __init__(self, repo_id, size=5000):
+        self.repo_id = repo_id
+        self.size = size
+        self.reset()
+
+    def reset(self):
+        self.commits = collections.OrderedDict()
+        self.by_id = {}
+
+    def load(self, keys, db):
+        keys = set(keys)
+        for key in keys:
+            if key in self.commits:
+                self.commits[key] = self.commits.pop(key)
+        keys = [x for x in keys if x not in self.commits]
+        if not keys:
+            return
+        _c = golem.db.commit
+        rows = []
+        for sha1s in chunked(list(set([x[1] for x in keys]))):
+            rows += [x for x in db.execute(_c.select().where(sql.and_(_c.c.repository==self.repo_id, _c.c.sha1.in_(sha1s))))
+                     if (x.ref, x.sha1) in keys]
+        self.add_commits(rows, db)
+
+    def add_commits(self, rows, db):
+        for row in rows:
+            self.commits[(row.ref, row.sha1)] = self.by_id[row.id] = {'id': row.id, 'ref': row.ref, 'sha1': row.sha1, 'prev_sha1': row.prev_sha1,
+                                                 'submit_time': row.submit_time, 'status': row.status, 'actions': {}}
+        self.load_actions([x.id for x in rows], db)
+
+    def load_actions(self, cids, db):
+        _a = golem.db.action
+        for cids in chunked(list(cids)):
+            for row in db.execute(sql.select([_a.c.id, _a.c.commit, _a.c.name, _a.c.status]).where(_a.c.commit.in_(cids))):
+                self.by_id[row.commit]['actions'][row.name] = {'id': row.id, 'status': row.status}
+
+    def commit(self, ref, sha1, db):
+        self.load([(ref, sha1)], db)
+        return self.commits.get((ref, sha1))
+
+    def last_commit(self, ref, db):
+        _c = golem.db.commit
+        row = db.execute(_c.select().where(sql.and_(_c.c.repository==self.repo_id, _c.c.ref==ref))
+                         .order_by(sql.desc(_c.c.submit_time)).limit(1)).fetchone()
+        if row:
+            return self.commit(row.ref, row.sha1, db)
+
+    def trim(self):
+        # Not while scheduling, which relies on the commits it loaded staying
+        while len(self.commits) > self.size:
+            key, c = self.commits.popitem(last=False)
+            self.by_id.pop(c['id'], None)
 
 # Copied from git-hub
-def github(try_login=False):
+# Shared by all reflog downloads, so connections are reused
+http_session = requests.Session()
+http_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=16))
+http_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=16))
+
+def github_login(try_login=False, validate=True):
     config_file = os.path.join(os.path.expanduser('~'), '.githubconfig-golem')
     old_umask = os.umask(63) # 0o077
     shell = whelk.Shell()
@@ -593,21 +1059,250 @@ def github(try_login=False):
     if not user or not token:
         raise GolemError("No github credentials found, try golem --login github")
 
-    gh = github3.login(username=user, token=token)
-    try:
-        gh.user()
-    except github3.GitHubError:
-        # Token obsolete
-        shell.git('config', '--file', config_file, '--unset', 'github.token')
-        gh = github(try_login)
+    # An alternative api endpoint, for github enterprise or a fake api server
+    url = shell.git('config', '--file', config_file, 'github.url').stdout.strip()
+    if url:
+        gh = github3.GitHubEnterprise(url, login=user, token=token)
+    else:
+        gh = github3.login(username=user, token=token)
+    if validate:
+        try:
+            gh.user()
+        except github3.GitHubError:
+            # Token obsolete
+            shell.git('config', '--file', config_file, '--unset', 'github.token')
+            gh = github_login(try_login)
     os.umask(old_umask)
     return gh
 
-_cache={}
-def cache(fnc, *args):
-    if (fnc,) + args not in _cache:
-        _cache[(fnc,) + args] = fnc(*args)
-    return _cache[(fnc,) + args]
+# One authenticated github client per process. Credentials are read once and
+# only checked with an extra api call after github rejected them. Api calls
+# are counted, per thread and in total.
+class GitHub(object):
+    def __init__(self):
+        self.gh = None
+        self.rejected = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.total = 0
+
+    def __call__(self, try_login=False):
+        with self.lock:
+            if not self.gh or self.rejected or try_login:
+                self.gh = github_login(try_login, validate=self.rejected or try_login)
+                self.gh._session.hooks['response'].append(self.count)
+                self.rejected = False
+        return self.gh
+
+    def count(self, response, *args, **kwargs):
+        self.local.calls = self.calls() + 1
+        with self.lock:
+            self.total += 1
+        if response.status_code == 401:
+            self.rejected = True
+
+    def calls(self):
+        return getattr(self.local, 'calls', 0)
+github = GitHub()
+
+# Change counters, bumped by the master whenever it writes the state of a
+# repository and read by the web interface to see if cached pages are still
+# valid. There is one per repository and one for all of them.
+_counter_lock = threading.Lock()
+def bump_counter(path):
+    with _counter_lock:
+        count = read_counter(path) + 1
+        with open(path + '.new', 'w') as fd:
+            fd.write('%d\n' % count)
+        os.rename(path + '.new', path)
+
+def read_counter(path):
+    try:
+        with open(path) as fd:
+            return int(fd.read().strip() or 0)
+    except (IOError, ValueError):
+        return 0
+
+# The latest commit of every repository, keyed by repository id, in a single
+# query
+def latest_commits(db):
+    _c = golem.db.commit
+    latest = sql.select([_c.c.repository, sql.func.max(_c.c.submit_time).label('submit_time')]).group_by(_c.c.repository).alias('latest')
+    query = _c.select().select_from(_c.join(latest, sql.and_(_c.c.repository==latest.c.repository, _c.c.submit_time==latest.c.submit_time)))
+    # Ties on submit_time are broken by id
+    return dict([(x.repository, x) for x in db.execute(query.order_by(_c.c.id)).fetchall()])
+
+# A bounded LRU cache for slow lookups such as github user names. Entries
+# expire after ttl seconds and, once open() is called, are also kept in an
+# sqlite database so they survive restarts. Values must be json-serializable.
+class Cache(object):
+    def __init__(self, size=1000, ttl=7*86400):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        self.hits = self.misses = 0
+
+    def open(self, path):
+        with self.lock:
+            self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+            self.db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, time REAL)")
+            self.db.execute("DELETE FROM cache WHERE time < ?", (time.time() - self.ttl,))
+
+    def get(self, key, fnc, *args):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if not entry and self.db:
+                row = self.db.execute("SELECT value, time FROM cache WHERE key = ?", (key,)).fetchone()
+                if row:
+                    entry = (json.loads(row[0]), row[1])
+            if entry and entry[1] > time.time() - self.ttl:
+                self.hits += 1
+                self.store(key, entry, False)
+                return entry[0]
+            self.misses += 1
+        # Don't hold the lock during the lookup itself
+        entry = (fnc(*args), time.time())
+        with self.lock:
+            self.store(key, entry, True)
+        return entry[0]
+
+    def store(self, key, entry, persist):
+        self.entries[key] = entry
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        if persist and self.db:
+            self.db.execute("INSERT OR REPLACE INTO cache (key, value, time) VALUES (?, ?, ?)", (key, json.dumps(entry[0]), entry[1]))
+            self.db.execute("DELETE FROM cache WHERE key NOT IN (SELECT key FROM cache ORDER BY time DESC LIMIT ?)", (self.size,))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+cache = Cache()
+
+def actor_name(gh, login):
+    return cache.get('github-name:%s' % login, lambda: gh.user(login).name)
+
+# A snapshot of the configuration of a git repository, read with a single git
+# config --list and reread only when the config file changes. Changes are
+# only written if they differ from the snapshot.
+class GitConfig(object):
+    def __init__(self, shell, path):
+        self.shell = shell
+        self.path = path
+        self.values = {}
+        for item in shell.git('config', '--list', '-z', cwd=path).stdout.split('\0'):
+            if item:
+                key, _, val = item.partition('\n')
+                self.values.setdefault(key, []).append(val)
+
+    def get(self, key):
+        return self.values.get(key, [None])[-1]
+
+    def set(self, changes):
+        changed = []
+        for key, val in sorted(changes.items()):
+            if self.get(key) == val:
+                continue
+            res = self.shell.git('config', key, val, cwd=self.path)
+            if res.returncode:
+                raise RuntimeError("git config %s failed: %s" % (key, res.stderr))
+            self.values[key] = [val]
+            changed.append(key)
+        return changed
+
+# Parsed chem files are pickled in <repo_dir>/.chem-cache, one file per chem,
+# keyed by path, mtime and a hash of this file, as it holds the code that does
+# the parsing and the classes that get pickled. Processes that can't write
+# there simply parse every time.
+def chem_cache_version():
+    try:
+        with open(os.path.splitext(__file__)[0] + '.py', 'rb') as fd:
+            return hashlib.sha1(fd.read()).hexdigest()
+    except IOError:
+        # No source next to the bytecode, this is the best we can do
+        return golem.__version__
+CHEM_CACHE_VERSION = chem_cache_version()
+
+def chem_cache_file(path, cache_dir):
+    return os.path.join(cache_dir, hashlib.sha1(os.path.abspath(path)).hexdigest() + '.pickle')
+
+def cached_chem(path, mtime, cache_dir):
+    try:
+        with open(chem_cache_file(path, cache_dir), 'rb') as fd:
+            data = cPickle.load(fd)
+    except Exception:
+        # Missing, unreadable, or a pickle of classes that have changed since
+        return None
+    if data['key'] == (os.path.abspath(path), mtime, CHEM_CACHE_VERSION):
+        return data['chem']
+
+def load_chem(path, mtime, cache_dir):
+    return cached_chem(path, mtime, cache_dir) or compile_chem(path, mtime, cache_dir)[1]
+
+def compile_chem(path, mtime, cache_dir):
+    chem = Chem(path, mtime)
+    data = cPickle.dumps({'key': (os.path.abspath(path), mtime, CHEM_CACHE_VERSION), 'chem': chem}, cPickle.HIGHEST_PROTOCOL)
+    cache_file = chem_cache_file(path, cache_dir)
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        with open('%s.%d' % (cache_file, os.getpid()), 'wb') as fd:
+            fd.write(data)
+        os.rename('%s.%d' % (cache_file, os.getpid()), cache_file)
+    except (IOError, OSError):
+        pass
+    return path, chem
+
+def _compile_chem(args):
+    # Errors are passed back to the parent to be raised or reported there
+    try:
+        return compile_chem(*args)
+    except Exception, e:
+        return args[0], e
+
+# Load many chem files, parsing the ones not in the cache in parallel. If an
+# errors dict is passed, broken chem files are reported there instead of
+# raising the first error.
+def load_chems(paths, cache_dir, errors=None, processes=None):
+    chems, misses = {}, []
+    for path in paths:
+        mtime = os.path.getmtime(path)
+        chems[path] = cached_chem(path, mtime, cache_dir)
+        if not chems[path]:
+            misses.append((path, mtime, cache_dir))
+    if len(misses) > 1:
+        # The workers inherit our signal handlers. The daemon's SIGTERM
+        # handler doesn't exit, which would make terminate() wait forever.
+        pool = multiprocessing.Pool(min(len(misses), processes or multiprocessing.cpu_count()),
+                                    initializer=signal.signal, initargs=(signal.SIGTERM, signal.SIG_DFL))
+        try:
+            results = pool.map(_compile_chem, misses)
+        finally:
+            pool.terminate()
+    else:
+        results = [_compile_chem(x) for x in misses]
+    for path, chem in results:
+        if isinstance(chem, Exception):
+            if errors is None:
+                raise chem
+            errors[path] = chem
+            del chems[path]
+        else:
+            chems[path] = chem
+    return chems
+
+_git_configs = {}
+def git_config(shell, path):
+    files = [os.path.join(path, 'config'), os.path.join(path, '.git', 'config')]
+    mtime = [os.path.getmtime(x) for x in files if os.path.exists(x)]
+    if path not in _git_configs or _git_configs[path][0] != mtime:
+        _git_configs[path] = (mtime, GitConfig(shell, path))
+    return _git_configs[path][1]
+
+def chunked(seq, size=500):
+    for i in range(0, len(seq), size):
+        yield seq[i:i+size]
 
 def sha1_file(file):
     sha = hashlib.new('sha1')
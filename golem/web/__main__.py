@@ -1,8 +1,12 @@
-from flask import Flask, g
+from flask import Flask, g, has_request_context, request
 import golem.web.views as v
+import golem.repository
 import golem.web.filters
 from golem.web.encoding import decode
 import os
+import sqlalchemy.event
+import threading
+import time
 
 class Defaults:
     MAX_SEARCH_DEPTH = 2
@@ -12,6 +16,13 @@ class Defaults:
     SENDER         = 'webmaster@localhost'
     DEBUG          = os.environ.get('GOLEM_DEBUG', 'False').lower() == 'true'
     THEME          = 'default'
+    CHEM_REFRESH_INTERVAL = 10
+    INDEX_CACHE_TIME = 5
+    RESPONSE_CACHE_TIME = 60
+    LOG_POLL_INTERVAL = 5
+    LOG_EVENTS = False
+    LOG_STREAM_TIME = 600
+    QUEUE_CACHE_TIME = 5
 
 class Golem(Flask):
     def __call__(self, environ, start_response):
@@ -45,22 +56,102 @@ class Master(object):
     dummy = True
 master = Master()
 
+# Keeps app.config['REPOS'] in sync with the chem files. Only added, changed
+# and removed files are reread, by a thread in every web process, and the new
+# set of repositories is swapped in at once. Requests never wait for this,
+# except the very first one in a process.
+class Repos(object):
+    def __init__(self, app):
+        self.app = app
+        self.mtimes = {}
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def start(self):
+        # Threads don't survive a fork, so this is done per process
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.refresh()
+            thread = threading.Thread(target=self.run, name='chem-refresh')
+            thread.daemon = True
+            thread.start()
+            self.pid = os.getpid()
+
+    def run(self):
+        while True:
+            time.sleep(self.app.config['CHEM_REFRESH_INTERVAL'])
+            try:
+                with self.lock:
+                    self.refresh()
+            except Exception:
+                self.app.logger.exception("Unable to refresh repositories")
+
+    def refresh(self):
+        chems = self.app.config['CHEMS']
+        mtimes = {}
+        for file in os.listdir(chems):
+            if not file.endswith('.conf'):
+                continue
+            try:
+                mtimes[os.path.join(chems, file)] = os.path.getmtime(os.path.join(chems, file))
+            except OSError:
+                # Removed while we were looking
+                pass
+        if mtimes == self.mtimes:
+            return
+
+        repos = dict(self.app.config.get('REPOS', {}))
+        by_file = dict([(x.configfile, x) for x in repos.values()])
+        for file in set(by_file) - set(mtimes):
+            del repos[by_file[file].name]
+        db = self.app.config['DB'].connect()
+        try:
+            for file, mtime in mtimes.items():
+                if mtime == self.mtimes.get(file):
+                    continue
+                try:
+                    repo = golem.repository.Repository(master, file, db)
+                except Exception:
+                    # Keep what we had, and try again when the file changes
+                    self.app.logger.exception("Unable to read %s" % file)
+                    continue
+                if file in by_file:
+                    repos.pop(by_file[file].name, None)
+                repos[repo.name] = repo
+        finally:
+            db.close()
+        self.mtimes = mtimes
+        self.app.config['REPOS'] = repos
+        # Cached pages of the old set of repositories are no longer valid
+        self.app.config['REPOS_VERSION'] = self.app.config.get('REPOS_VERSION', 0) + 1
+repos = Repos(app)
+
 @app.before_first_request
 def before_first_reques():
     master.repo_dir = app.config['REPODIR']
-    app.config['REPOS'] = {}
+    if app.debug:
+        sqlalchemy.event.listen(app.config['DB'], 'before_cursor_execute', count_query)
+
+# In debug mode, the number of queries for each request is logged and sent
+# as a header
+def count_query(*args):
+    if has_request_context():
+        g.queries = getattr(g, 'queries', 0) + 1
+
+@app.after_request
+def after_request(response):
+    if app.debug:
+        response.headers['X-Golem-Queries'] = str(getattr(g, 'queries', 0))
+        app.logger.debug("%d queries for %s" % (getattr(g, 'queries', 0), request.path))
+    return response
 
 @app.before_request
 def before_request():
     g.db = app.config['DB'].connect()
-
-    if app.config.get('MTIME',-1) < os.path.getmtime(app.config['CHEMS']):
-        app.config['MTIME'] = os.path.getmtime(app.config['CHEMS'])
-        for file in os.listdir(app.config['CHEMS']):
-            if not file.endswith('.conf'):
-                continue
-            repo = golem.repository.Repository(master, os.path.join(app.config['CHEMS'], file), g.db)
-            app.config['REPOS'][repo.name] = repo
+    repos.start()
 
 @app.teardown_request
 def teardown_request(exception):
@@ -74,8 +165,11 @@ app.static_folder = os.path.join('themes', app.config['THEME'], 'static')
 # URL structure
 app.add_url_rule('/', view_func=v.IndexView.as_view('index'))
 app.add_url_rule('/queues/', view_func=v.QueueView.as_view('queues'))
+app.add_url_rule('/queues.json', view_func=v.QueueJsonView.as_view('queues_json'))
 app.add_url_rule('/<repo>/', view_func=v.RepoView.as_view('repo'))
 app.add_url_rule('/<repo>/<path:ref>/<sha1>/', view_func=v.RunView.as_view('run'))
+app.add_url_rule('/<repo>/<path:ref>/<sha1>/tail/<action>', view_func=v.LogView.as_view('tail'))
+app.add_url_rule('/<repo>/<path:ref>/<sha1>/tail/<action>/events', view_func=v.LogEventsView.as_view('tail_events'))
 app.add_url_rule('/<repo>/<path:ref>/<sha1>/artefact/<action>/<path:filename>', view_func=v.ArtefactView.as_view('artefact'))
 
 # Logging
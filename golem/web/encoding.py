@@ -1,14 +1,54 @@
-import chardet
+import chardet.universaldetector
+import collections
+import threading
+
+# chardet is slow, so it only gets to see a sample of the data, starting just
+# before the first byte that isn't utf-8, and stops as soon as it is sure.
+SAMPLE_SIZE = 64 * 1024
+CHUNK_SIZE = 4096
+
+def detect(data, start=0):
+    detector = chardet.universaldetector.UniversalDetector()
+    start = max(0, start - CHUNK_SIZE)
+    for offset in range(start, min(len(data), start + SAMPLE_SIZE), CHUNK_SIZE):
+        detector.feed(data[offset:offset+CHUNK_SIZE])
+        if detector.done:
+            break
+    return detector.close()['encoding']
 
 def decode(data, encoding=None):
     if isinstance(data, unicode):
         return data
     if encoding:
-        return data.decode(encoding)
+        return data.decode(encoding, 'replace')
     try:
         return data.decode('utf-8')
-    except UnicodeDecodeError:
-        encoding = chardet.detect(data)['encoding']
+    except UnicodeDecodeError, e:
+        encoding = detect(data, e.start)
         if not encoding:
             return "(Binary data)"
-        return data.decode(encoding)
+        return data.decode(encoding, 'replace')
+
+# Artefacts that aren't utf-8, such as logs, are read in pieces. Their
+# encoding is detected once, from the first piece that needs it.
+encodings = collections.OrderedDict()
+encodings_lock = threading.Lock()
+
+def decode_file(path, data):
+    if isinstance(data, unicode):
+        return data
+    with encodings_lock:
+        encoding = encodings.pop(path, None)
+        if encoding:
+            encodings[path] = encoding
+    if encoding:
+        return data.decode(encoding, 'replace')
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError, e:
+        encoding = detect(data, e.start) or 'utf-8'
+    with encodings_lock:
+        encodings[path] = encoding
+        while len(encodings) > 1000:
+            encodings.popitem(last=False)
+    return data.decode(encoding, 'replace')
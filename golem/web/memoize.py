@@ -1,14 +1,42 @@
-class memoize:
-    def __init__(self, function):
+import collections
+import threading
+import time
+
+# Remembers the last `size` results of a function, for at most `ttl` seconds
+# if a ttl is given. Objects with a path, such as repositories, are
+# remembered by that path. Use as @memoize or @memoize(size=100, ttl=60).
+class memoize(object):
+    def __init__(self, function=None, size=1000, ttl=None):
         self.function = function
-        self.memoized = {}
+        self.size = size
+        self.ttl = ttl
+        self.memoized = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
 
     def __call__(self, *args):
+        if self.function is None:
+            self.function = args[0]
+            return self
         args_ = args
         if args and hasattr(args[0], 'path'):
             args_ = (args[0].path,) + args[1:]
-        try:
-            return self.memoized[args_]
-        except KeyError:
-            self.memoized[args_] = self.function(*args)
-        return self.memoized[args_]
+        with self.lock:
+            result = self.memoized.pop(args_, None)
+            if result and (not self.ttl or result[0] > time.time()):
+                self.memoized[args_] = result
+                self.hits += 1
+                return result[1]
+            self.misses += 1
+        # Not under the lock, a slow call shouldn't hold up the others
+        value = self.function(*args)
+        with self.lock:
+            self.memoized[args_] = (time.time() + (self.ttl or 0), value)
+            while len(self.memoized) > self.size:
+                self.memoized.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.memoized), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
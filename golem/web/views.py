@@ -1,18 +1,56 @@
 from flask.views import View
-from flask import render_template, current_app, redirect, url_for, request, send_file, g
+from flask import render_template, current_app, redirect, url_for, request, send_file, g, Response, jsonify
+from golem.web.encoding import decode_file
+import collections
 import os
 import beanstalkc
+import golem.repository
 import json
+import threading
+import time
 
 class TemplateView(View):
     def render(self, context):
         return render_template(self.template_name, **context)
 
+# Rendered pages are kept until the change counter they were rendered at
+# moves on, which the master does whenever it writes to the database, or until
+# RESPONSE_CACHE_TIME seconds have passed, as pages show relative times.
+class PageCache(object):
+    def __init__(self, size=500):
+        self.size = size
+        self.pages = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, counter, render):
+        with self.lock:
+            page = self.pages.pop(key, None)
+            if page and page[0] == counter and page[1] > time.time():
+                self.pages[key] = page
+                return page[2]
+        data = render()
+        with self.lock:
+            self.pages[key] = (counter, time.time() + current_app.config['RESPONSE_CACHE_TIME'], data)
+            while len(self.pages) > self.size:
+                self.pages.popitem(last=False)
+        return data
+pages = PageCache()
+
 class IndexView(TemplateView):
     template_name = 'index.html'
+    # Shared by all requests in this process: (expiry time, change counter, latest commits)
+    latest = (0, None, None)
 
     def dispatch_request(self):
-        return self.render({'repos': current_app.config['REPOS']})
+        counter = golem.repository.read_counter(os.path.join(current_app.config['REPODIR'], '.changes'))
+        return pages.get(('index', current_app.config['REPOS_VERSION']), counter, lambda: self.render_index(counter))
+
+    def render_index(self, counter):
+        expires, counter_, latest = IndexView.latest
+        if expires < time.time() or counter_ != counter:
+            latest = golem.repository.latest_commits(g.db)
+            IndexView.latest = (time.time() + current_app.config['INDEX_CACHE_TIME'], counter, latest)
+        return self.render({'repos': current_app.config['REPOS'], 'latest': latest})
 
 class RepoView(TemplateView):
     template_name = 'repo.html'
@@ -21,7 +59,11 @@ class RepoView(TemplateView):
         if repo not in current_app.config['REPOS']:
             return "No such repo", 404
         repo = current_app.config['REPOS'][repo]
-        return self.render({'repo': repo})
+        count = min(request.args.get('count', 10, type=int), 100)
+        return pages.get(('repo', repo.name, repo.mtime, count), repo.changes(),
+                         lambda: self.render({'repo': repo, 'runs': repo.last_runs(count, g.db)}))
+
+class NoSuchCommit(Exception): pass
 
 class RunView(TemplateView):
     template_name = 'run.html'
@@ -30,10 +72,16 @@ class RunView(TemplateView):
         if repo not in current_app.config['REPOS']:
             return "No such repo", 404
         repo = current_app.config['REPOS'][repo]
+        try:
+            return pages.get(('run', repo.name, repo.mtime, ref, sha1), repo.changes(), lambda: self.render_run(repo, ref, sha1))
+        except NoSuchCommit:
+            return "No such commit", 404
+
+    def render_run(self, repo, ref, sha1):
         commit = repo.commit(ref, sha1, g.db)
         if not commit:
-            return "No such commit", 404
-        actions = repo.actions_for(ref, sha1, g.db)
+            raise NoSuchCommit()
+        actions = repo.actions_for_commits([commit.id], g.db)[commit.id]
         actions = [x for x in actions if x['start_time']] + [x for x in actions if not x['start_time']]
         return self.render({'repo': repo, 'commit': commit, 'actions': actions})
 
@@ -48,19 +96,187 @@ class ArtefactView(View):
         mimetype = None
         if filename == 'log':
             mimetype = 'text/plain'
-        return send_file(path, attachment_filename=os.path.basename(filename), as_attachment=False, mimetype=mimetype)
+        # Artefacts are identified by their sha1. Logs aren't in the database
+        # and can still grow, so they get flask's etag based on mtime and size.
+        artefact = repo.artefact(ref, sha1, action, filename, g.db)
+        response = send_file(path, attachment_filename=os.path.basename(filename), as_attachment=False, mimetype=mimetype,
+                             add_etags=not artefact)
+        if artefact:
+            response.set_etag(artefact.sha1)
+        # With X-Sendfile or X-Accel-Redirect, the webserver sends the file
+        # and deals with ranges itself, we only tell clients it does
+        if current_app.use_x_sendfile:
+            response = response.make_conditional(request, accept_ranges=True)
+        else:
+            response = response.make_conditional(request, accept_ranges=True, complete_length=os.path.getsize(path))
+        if response.status_code == 304:
+            response.headers.pop('X-Sendfile', None)
+        return response
+
+# Running jobs ship their log to the master every few seconds. The run page
+# polls the tail view for what was added after a given offset, so following a
+# log doesn't mean downloading it over and over. Both views send whole lines
+# only, until the action is done.
+def read_log(path, offset):
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return '', 0
+    if offset > size:
+        # The log was started over, e.g. when a job is rescheduled
+        offset = 0
+    with open(path) as fd:
+        fd.seek(offset)
+        return fd.read(size - offset), offset
+
+def log_path(repo, ref, sha1, action):
+    return os.path.join(repo.path, 'artefacts', action, '%s@%s' % (ref, sha1), 'log')
+
+def action_running(engine, repo, ref, sha1, action):
+    db = engine.connect()
+    try:
+        commit = repo.commit(ref, sha1, db)
+        if not commit:
+            return False
+        actions = repo.actions_for_commits([commit.id], db)[commit.id]
+        return any(x['name'] == action and x['status'] in ('new', 'scheduled', 'started') for x in actions)
+    finally:
+        db.close()
+
+class LogView(View):
+    def dispatch_request(self, repo, ref, sha1, action):
+        if repo not in current_app.config['REPOS']:
+            return "No such repo", 404
+        repo = current_app.config['REPOS'][repo]
+        path = log_path(repo, ref, sha1, action)
+        data, offset = read_log(path, request.args.get('offset', 0, type=int))
+        lines = data[:data.rfind('\n')+1]
+        done = False
+        # The database is only asked when there's nothing new to send
+        if not lines and not action_running(current_app.config['DB'], repo, ref, sha1, action):
+            lines, done = data, True
+        response = Response(decode_file(path, lines).encode('utf-8'), mimetype='text/plain')
+        response.headers['X-Log-Offset'] = str(offset + len(lines))
+        response.headers['Cache-Control'] = 'no-cache'
+        if done:
+            response.headers['X-Log-Done'] = '1'
+        return response
+
+# The same as a stream of server-sent events. Every stream keeps a worker
+# busy for up to LOG_STREAM_TIME seconds, so this is only available when
+# LOG_EVENTS is set, for deployments with workers to spare.
+class LogEventsView(View):
+    def dispatch_request(self, repo, ref, sha1, action):
+        if not current_app.config['LOG_EVENTS']:
+            return "Log streaming is disabled", 404
+        if repo not in current_app.config['REPOS']:
+            return "No such repo", 404
+        repo = current_app.config['REPOS'][repo]
+        path = log_path(repo, ref, sha1, action)
+        offset = request.headers.get('Last-Event-ID', type=int) or request.args.get('offset', 0, type=int)
+        engine = current_app.config['DB']
+        deadline = time.time() + current_app.config['LOG_STREAM_TIME']
+
+        def event(data, offset, name=None):
+            lines = ['data: %s' % x for x in decode_file(path, data).encode('utf-8').split('\n')]
+            return '%sid: %d\n%s\n\n' % (name and 'event: %s\n' % name or '', offset, '\n'.join(lines))
+
+        def events(offset):
+            counter = None
+            while time.time() < deadline:
+                data, offset = read_log(path, offset)
+                # Only whole lines, the rest follows with the next sync
+                data = data[:data.rfind('\n')+1]
+                if data:
+                    offset += len(data)
+                    yield event(data[:-1], offset)
+                    continue
+                # The database is only asked once the master did something
+                if counter != repo.changes():
+                    counter = repo.changes()
+                    if not action_running(engine, repo, ref, sha1, action):
+                        data, offset = read_log(path, offset)
+                        yield event(data, offset + len(data), 'done')
+                        return
+                time.sleep(1)
+
+        return Response(events(offset), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# One beanstalk connection per web process, reconnected when it breaks, and
+# tube stats that are at most QUEUE_CACHE_TIME seconds old. Stale stats are
+# served while a thread fetches new ones; only the first request waits.
+class QueueStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bs = None
+        self.pid = None
+        self.queues = None
+        self.updated = 0
+        self.refreshing = False
+
+    def connection(self, server):
+        # Connections can't be shared with a forked child
+        if self.bs is None or self.pid != os.getpid():
+            host, port = server.split(':')
+            self.bs = beanstalkc.Connection(host, int(port))
+            self.pid = os.getpid()
+        return self.bs
+
+    def fetch(self, server):
+        for attempt in (1, 2):
+            try:
+                bs = self.connection(server)
+                queues = {}
+                for tube in bs.tubes():
+                    if not tube.startswith('golem-'):
+                        continue
+                    try:
+                        queues[tube] = {'name': tube, 'jobs': [], 'stats': bs.stats_tube(tube)}
+                    except beanstalkc.CommandFailed:
+                        # Tubes disappear when their last watcher leaves
+                        pass
+                return queues
+            except beanstalkc.SocketError:
+                if self.bs is not None and self.pid == os.getpid():
+                    self.bs.close()
+                self.bs = None
+                if attempt == 2:
+                    raise
+
+    def refresh(self, app):
+        try:
+            with self.lock:
+                self.queues = self.fetch(app.config['BEANSTALK_SERVER'])
+                self.updated = time.time()
+        except Exception:
+            app.logger.exception("Unable to fetch queue stats")
+        finally:
+            self.refreshing = False
+
+    def get(self):
+        app = current_app._get_current_object()
+        if self.queues is None:
+            with self.lock:
+                if self.queues is None:
+                    self.queues = self.fetch(app.config['BEANSTALK_SERVER'])
+                    self.updated = time.time()
+        elif not self.refreshing and self.updated + app.config['QUEUE_CACHE_TIME'] < time.time():
+            self.refreshing = True
+            thread = threading.Thread(target=self.refresh, args=(app,), name='queue-stats')
+            thread.daemon = True
+            thread.start()
+        return self.queues, self.updated
+queue_stats = QueueStats()
 
 class QueueView(TemplateView):
     template_name = 'queues.html'
 
     def dispatch_request(self):
-        host, port = current_app.config['BEANSTALK_SERVER'].split(':')
-        bs = beanstalkc.Connection(host, int(port))
-        queues = dict([(x, {'name': x, 'jobs': [], 'stats': None}) for x in bs.tubes() if x.startswith('golem-')])
-        for queue in queues:
-            bs.watch(queue)
-            bs.use(queue)
-            queues[queue]['stats'] = qstats = bs.stats_tube(queue)
-        bs.close()
-
+        queues, updated = queue_stats.get()
         return self.render({'queues': queues})
+
+class QueueJsonView(View):
+    def dispatch_request(self):
+        queues, updated = queue_stats.get()
+        return jsonify(updated=updated, queues=dict([(x, queues[x]['stats']) for x in queues]))
@@ -8,6 +8,7 @@ import json
 import logging
 import re
 import shutil
+import threading
 import time
 import random
 import socket
@@ -43,29 +44,33 @@ class Worker(Daemon):
         self.bs.use(self.submit_queue)
         self.bs.put(json.dumps(to_submit), ttr=600)
 
-        if self.repo_sync:
-            job.run_hook('pre-sync')
-            job.sync()
-            job.run_hook('post-sync')
-
-        os.chdir(job.work_path)
+        job.start_log_sync()
+        try:
+            if self.repo_sync:
+                job.run_hook('pre-sync')
+                job.sync()
+                job.run_hook('post-sync')
 
-        if self.repo_checkout:
-            job.run_hook('pre-checkout')
-            job.checkout(job.sha1)
             os.chdir(job.work_path)
-            job.run_hook('post-checkout')
 
-        try:
-            self.setup(job)
-            self.process_job_simple(job)
-            job.result = 'success'
-        except GolemRetryLater, e:
-            self.logger.error(unicode(e).encode('utf-8'))
-            job.result = 'retry'
-        except GolemError, e:
-            self.logger.error(unicode(e).encode('utf-8'))
-            job.result = 'fail'
+            if self.repo_checkout:
+                job.run_hook('pre-checkout')
+                job.checkout(job.sha1)
+                os.chdir(job.work_path)
+                job.run_hook('post-checkout')
+
+            try:
+                self.setup(job)
+                self.process_job_simple(job)
+                job.result = 'success'
+            except GolemRetryLater, e:
+                self.logger.error(unicode(e).encode('utf-8'))
+                job.result = 'retry'
+            except GolemError, e:
+                self.logger.error(unicode(e).encode('utf-8'))
+                job.result = 'fail'
+        finally:
+            job.stop_log_sync()
         os.chdir('/')
         job.run_hook('pre-publish')
         job.publish_results()
@@ -178,13 +183,43 @@ class Job(object):
         if self.shell.git('submodule').stdout.strip():
             self.shell.git('submodule', 'update')
 
+    def remote_artefact_path(self):
+        return '/'.join([self.worker.rsync_root, self.repo, 'artefacts', self.action, '%s@%s' % (self.ref, self.sha1)]) + os.sep
+
+    def start_log_sync(self):
+        # Ship the log to the master while the job runs, so it can be followed
+        # in the web interface. After the first copy, rsync --append only
+        # sends what was added since.
+        self.log_sync_stop = threading.Event()
+        interval = float(self.worker.config.get('log_sync_interval', 0) or 0)
+        if not interval or not self.worker.rsync_root:
+            return
+        self.log_sync_thread = threading.Thread(target=self.sync_log, args=(interval,), name='log-sync')
+        self.log_sync_thread.daemon = True
+        self.log_sync_thread.start()
+
+    def sync_log(self, interval):
+        args = ['-a', self.log, self.remote_artefact_path()]
+        if self.worker.rsync_password:
+            args += ['--password-file', self.worker.rsync_password]
+        synced = False
+        while not self.log_sync_stop.wait(interval):
+            # Not through self.shell, its output would end up in the log itself
+            res = whelk.shell.rsync(*((synced and ['--append'] or []) + args))
+            synced = synced or res.returncode == 0
+
+    def stop_log_sync(self):
+        self.log_sync_stop.set()
+        if getattr(self, 'log_sync_thread', None):
+            self.log_sync_thread.join()
+
     def publish_results(self):
         for glb in getattr(self, 'publish', []):
             for file in glob.glob(os.path.join(self.work_path, glb)):
                 self.logger.info("Adding artefact %s" % file.replace(self.work_path, ''))
                 os.rename(file, os.path.join(self.artefact_path, os.path.basename(file)))
         local = self.artefact_path + os.sep
-        remote = '/'.join([self.worker.rsync_root, self.repo, 'artefacts', self.action, '%s@%s' % (self.ref, self.sha1)]) + os.sep
+        remote = self.remote_artefact_path()
         self.logger.info("Publishing %s => %s" % (local, remote))
         args = ['-av', local, remote]
         if self.worker.rsync_password:
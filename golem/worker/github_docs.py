@@ -19,6 +19,7 @@ class Daemon(Worker):
                 os.unlink(f)
 
         gh = github()
+        calls = github.calls()
         repo = gh.repository(*job.github_repo.split('/'))
         branch = repo.ref('heads/gh-pages')
 
@@ -57,3 +58,4 @@ class Daemon(Worker):
                 branch.update(commit.sha)
             else:
                 self.logger.info("No change, not creating commit")
+        self.logger.info("Made %d github api calls" % (github.calls() - calls))